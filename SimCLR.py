@@ -1,10 +1,9 @@
-import math
 from argparse import ArgumentParser
 
 import torch
 from pytorch_lightning import LightningModule, Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
-from torch import nn, Tensor
+from torch import nn
 from torch.nn import functional as F
 import module.resnet as resnet
 from pl_bolts.models.self_supervised.resnets import resnet18, resnet50
@@ -17,27 +16,97 @@ from pl_bolts.transforms.dataset_normalizations import (
 )
 from ContrastiveLoss import ContrastiveLoss, NTXentLoss
 import numpy as np
+
+# allow TF32 tensor cores for the float32 matmuls that stay outside autocast
+torch.set_float32_matmul_precision('high')
+
+
 class SyncFunction(torch.autograd.Function):
 
     @staticmethod
     def forward(ctx, tensor):
         ctx.batch_size = tensor.shape[0]
+        world_size = torch.distributed.get_world_size()
 
-        gathered_tensor = [torch.zeros_like(tensor) for _ in range(torch.distributed.get_world_size())]
-
-        torch.distributed.all_gather(gathered_tensor, tensor)
-        gathered_tensor = torch.cat(gathered_tensor, 0)
+        # gather straight into one contiguous buffer: [world_size * batch_size, ...]
+        gathered_tensor = torch.empty(
+            world_size * ctx.batch_size, *tensor.shape[1:], device=tensor.device, dtype=tensor.dtype
+        )
+        torch.distributed.all_gather_into_tensor(gathered_tensor, tensor.contiguous())
 
         return gathered_tensor
 
     @staticmethod
     def backward(ctx, grad_output):
-        grad_input = grad_output.clone()
-        torch.distributed.all_reduce(grad_input, op=torch.distributed.ReduceOp.SUM, async_op=False)
+        # sum the gradients from every rank and keep only the local slice in one collective
+        grad_input = torch.empty(
+            ctx.batch_size, *grad_output.shape[1:], device=grad_output.device, dtype=grad_output.dtype
+        )
+        torch.distributed.reduce_scatter_tensor(
+            grad_input, grad_output.contiguous(), op=torch.distributed.ReduceOp.SUM
+        )
+        return grad_input
+
+
+class LogSumExpMM(torch.autograd.Function):
+    """
+        row-wise logsumexp(out @ out_dist.T * inv_temperature) without materializing the full logits
+        out_dist is processed in column blocks with an online logsumexp, the backward recomputes
+        each block from the saved row logsumexp, so only a [rows, block_size] tile is ever live
+    """
+
+    @staticmethod
+    def forward(ctx, out, out_dist, inv_temperature, block_size):
+        ctx.inv_temperature = inv_temperature
+        ctx.block_size = block_size
+
+        lse = torch.full((out.shape[0],), float('-inf'), device=out.device, dtype=out.dtype)
+        for start in range(0, out_dist.shape[0], block_size):
+            logits = torch.mm(out, out_dist[start:start + block_size].t()) * inv_temperature
+            lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+
+        ctx.save_for_backward(out, out_dist, lse)
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad_lse):
+        out, out_dist, lse = ctx.saved_tensors
+        inv_temperature, block_size = ctx.inv_temperature, ctx.block_size
+
+        grad_out = torch.zeros_like(out)
+        grad_out_dist = torch.empty_like(out_dist)
+        for start in range(0, out_dist.shape[0], block_size):
+            block = out_dist[start:start + block_size]
+            # d lse_i / d logits_ij is softmax_ij, scaled by the incoming row gradient and 1 / temp
+            prob = torch.exp(torch.mm(out, block.t()) * inv_temperature - lse[:, None])
+            prob = prob * (grad_lse[:, None] * inv_temperature)
+            grad_out += torch.mm(prob, block)
+            grad_out_dist[start:start + block_size] = torch.mm(prob.t(), out)
+
+        return grad_out, grad_out_dist, None, None
+
 
-        idx_from = torch.distributed.get_rank() * ctx.batch_size
-        idx_to = (torch.distributed.get_rank() + 1) * ctx.batch_size
-        return grad_input[idx_from:idx_to]
+def _nt_xent(out, out_dist, temperature: float, eps: float = 1e-6, block_size: int = 4096):
+    # out: [2 * batch_size, dim], view 1 stacked on view 2
+    # out_dist: [2 * batch_size * world_size, dim]
+    out_1, out_2 = out.chunk(2, dim=0)
+    # scale the logits with a multiply, the division is done once on the host
+    inv_temperature = 1.0 / temperature
+
+    # logits: [2 * batch_size, 2 * batch_size * world_size], only ever built block_size columns at a time
+    # log_neg: [2 * batch_size], log of the row sums of exp(logits)
+    log_neg = LogSumExpMM.apply(out, out_dist, inv_temperature, block_size)
+
+    # from each row, remove e^(1/temp), the similarity measure for x1.x1, in log-space
+    log_neg = log_neg + torch.log1p(-torch.exp(inv_temperature - log_neg).clamp(max=1 - eps))
+
+    # Positive logits, pos_logit becomes [2 * batch_size]
+    pos_logit = torch.sum(out_1 * out_2, dim=-1) * inv_temperature
+    pos_logit = torch.cat([pos_logit, pos_logit], dim=0)
+
+    loss = -(pos_logit - log_neg).mean()
+
+    return loss
 
 
 class Projection(nn.Module):
@@ -48,8 +117,10 @@ class Projection(nn.Module):
         self.input_dim = input_dim
         self.hidden_dim = hidden_dim
 
+        # 3-layer SimCLRv2 projection head
         self.model = nn.Sequential(
-            nn.Linear(self.input_dim, self.hidden_dim), nn.BatchNorm1d(self.hidden_dim), nn.ReLU(),
+            nn.Linear(self.input_dim, self.hidden_dim), nn.BatchNorm1d(self.hidden_dim), nn.ReLU(inplace=True),
+            nn.Linear(self.hidden_dim, self.hidden_dim), nn.BatchNorm1d(self.hidden_dim), nn.ReLU(inplace=True),
             nn.Linear(self.hidden_dim, self.output_dim, bias=False)
         )
 
@@ -80,6 +151,7 @@ class SimCLR(LightningModule):
         learning_rate: float = 3e-4,
         final_lr: float = 0.,
         weight_decay: float = 1e-6,
+        compile_model: bool = True,
         **kwargs
     ):
         """
@@ -90,6 +162,7 @@ class SimCLR(LightningModule):
             lr: the optimizer learning rate
             opt_weight_decay: the optimizer weight decay
             loss_temperature: the loss temperature
+            compile_model: compile the encoder, projection head and loss with torch.compile
         """
         super().__init__()
 
@@ -114,19 +187,28 @@ class SimCLR(LightningModule):
         self.learning_rate = learning_rate
         self.warmup_epochs = warmup_epochs
         self.max_epochs = max_epochs
+        self.compile_model = compile_model
 
-        self.train_loss = []
+        # running sum of the detached step losses, kept on device to avoid a sync every step
+        self.train_loss_sum = 0.
+        self.train_loss_count = 0
 
-        self.encoder = self.init_model()
+        # NHWC weights and inputs select the cuDNN tensor-core convolutions under autocast
+        self.encoder = self.init_model().to(memory_format=torch.channels_last)
         if arch == 'resnet50':
-            self.features = nn.Linear(self.hidden_mlp, self.hidden_mlp) #First Projection Head
-            self.batch_norm1d = nn.BatchNorm1d(self.hidden_mlp)
             self.projection = Projection(input_dim=self.hidden_mlp, hidden_dim=self.hidden_mlp, output_dim=self.feat_dim)
         elif arch == 'resnet18':
-            self.features = nn.Linear(512, 512) #First Projection Head
-            self.batch_norm1d = nn.BatchNorm1d(512)
             self.projection = Projection(input_dim=512, hidden_dim=512, output_dim=self.feat_dim)
 
+        if self.compile_model:
+            # compiled in place so the state_dict keys stay the same for checkpoints and fine-tuning,
+            # both modes capture CUDA graphs, each module and the loss run once per step on the concatenated views
+            self.encoder.compile(mode='max-autotune')
+            self.projection.compile(mode='reduce-overhead')
+            self._nt_xent = torch.compile(_nt_xent, mode='reduce-overhead')
+        else:
+            self._nt_xent = _nt_xent
+
         global_batch_size = self.num_nodes * self.gpus * self.batch_size if self.gpus > 0 else self.batch_size
         self.train_iters_per_epoch = self.num_samples // global_batch_size
 
@@ -141,71 +223,43 @@ class SimCLR(LightningModule):
         return backbone
     
     def forward(self, x):
-        x = self.encoder(x)
-        return self.features(x)
+        return self.encoder(x.contiguous(memory_format=torch.channels_last))
     
-    def nt_xent_loss(self, out_1, out_2, temperature, eps=1e-6):
+    def nt_xent_loss(self, out, temperature, eps=1e-6):
         """
-            assume out_1 and out_2 are normalized
-            out_1: [batch_size, dim]
-            out_2: [batch_size, dim]
+            assume out is normalized
+            out: [2 * batch_size, dim], the first half are the view 1 features, the second half view 2
         """
         # gather representations in case of distributed training
-        # out_1_dist: [batch_size * world_size, dim]
-        # out_2_dist: [batch_size * world_size, dim]
+        # out_dist: [2 * batch_size * world_size, dim]
+        # rows are grouped per rank rather than per view, the negatives sum over all of them anyway
         if torch.distributed.is_available() and torch.distributed.is_initialized():
-            out_1_dist = SyncFunction.apply(out_1)
-            out_2_dist = SyncFunction.apply(out_2)
+            out_dist = SyncFunction.apply(out)
         else:
-            out_1_dist = out_1
-            out_2_dist = out_2
-
-        # out: [2 * batch_size, dim]
-        # out_dist: [2 * batch_size * world_size, dim]
-        out = torch.cat([out_1, out_2], dim=0)
-        out_dist = torch.cat([out_1_dist, out_2_dist], dim=0)
-
-        # cov and sim: [2 * batch_size, 2 * batch_size * world_size]
-        # neg: [2 * batch_size]
-        cov = torch.mm(out, out_dist.t().contiguous())
-        sim = torch.exp(cov / temperature)
-        neg = sim.sum(dim=-1)
-
-        # from each row, subtract e^(1/temp) to remove similarity measure for x1.x1
-        row_sub = Tensor(neg.shape).fill_(math.e**(1 / temperature)).to(neg.device)
-        neg = torch.clamp(neg - row_sub, min=eps)  # clamp for numerical stability
+            out_dist = out
 
-        # Positive similarity, pos becomes [2 * batch_size]
-        pos = torch.exp(torch.sum(out_1 * out_2, dim=-1) / temperature)
-        pos = torch.cat([pos, pos], dim=0)
-
-        loss = -torch.log(pos / (neg + eps)).mean()
-
-        return loss
+        # keep the loss math in fp32 under mixed precision, logsumexp underflows in bf16/fp16
+        with torch.autocast(device_type=out.device.type, enabled=False):
+            return self._nt_xent(out.float(), out_dist.float(), temperature, eps)
 
     def shared_step(self, batch):
         (img1, img2, _), y = batch
 
-        features_1 = self(img1)
-        features_2 = self(img2)
-
-        features_1 = F.relu(self.batch_norm1d(features_1))
-        features_2 = F.relu(self.batch_norm1d(features_2))
-
-        features_1 = self.projection(features_1)
-        features_2 = self.projection(features_2)
+        # run both views through the encoder and head in one batch, BN sees all 2 * batch_size samples
+        features = self.projection(self(torch.cat([img1, img2], dim=0)))
         # batch_size = y.shape[0]//2
         # features = self.projection(features)
         # f1, f2 = torch.split(features, (batch_size,batch_size), dim=0)
         # features = torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1)
         
-        loss = self.nt_xent_loss(features_1,features_2,0.5)
+        loss = self.nt_xent_loss(features,0.5)
 
         return loss
 
     def training_step(self, batch, batch_idx):
         loss = self.shared_step(batch)
-        self.train_loss.append(loss)
+        self.train_loss_sum += loss.detach()
+        self.train_loss_count += 1
 
         self.log('train_loss', loss, on_step=True, prog_bar=True, on_epoch=False)
 
@@ -220,13 +274,14 @@ class SimCLR(LightningModule):
     
     def on_train_epoch_end(self):
         print('training end: \n')
-        avg_train_loss = sum(self.train_loss) / len(self.train_loss)
+        avg_train_loss = self.train_loss_sum / self.train_loss_count
         print("average train loss",avg_train_loss)
         # avg_loss = torch.stack([x['train_loss'] for x in outputs]).mean()
         # self.log('avg_train_loss', avg_loss, on_step=False, sync_dist=True)
         # return {'avg_train_loss': avg_loss, 'log': {'Loss/avg_train_loss': avg_loss}}
         self.log('avg_train_loss', avg_train_loss)
-        self.train_loss = []
+        self.train_loss_sum = 0.
+        self.train_loss_count = 0
 
     def configure_optimizers(self):
         if self.exclude_bn_bias:
@@ -249,10 +304,14 @@ class SimCLR(LightningModule):
         warmup_steps = self.train_iters_per_epoch * self.warmup_epochs
         total_steps = self.train_iters_per_epoch * self.max_epochs
 
+        # tabulate the warmup + cosine multipliers once, the scheduler then only indexes per step
+        lr_lambda = linear_warmup_decay(warmup_steps, total_steps, cosine=True)
+        lr_table = [lr_lambda(step) for step in range(total_steps + 1)]
+
         scheduler = {
             "scheduler": torch.optim.lr_scheduler.LambdaLR(
                 optimizer,
-                linear_warmup_decay(warmup_steps, total_steps, cosine=True),
+                lambda step: lr_table[min(step, total_steps)],
             ),
             "interval": "step",
             "frequency": 1,
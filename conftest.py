@@ -0,0 +1,2 @@
+# test.py is a scratch script that runs at import, keep it out of pytest collection
+collect_ignore = ["test.py"]
@@ -0,0 +1,53 @@
+import math
+
+import torch
+from torch.nn import functional as F
+
+from SimCLR import LogSumExpMM, _nt_xent
+
+
+def _inputs(rows=5, cols=7, dim=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    out = torch.randn(rows, dim, generator=generator, dtype=torch.float64, requires_grad=True)
+    out_dist = torch.randn(cols, dim, generator=generator, dtype=torch.float64, requires_grad=True)
+    return out, out_dist
+
+
+def test_logsumexp_mm_gradcheck_ragged_blocks():
+    # 7 columns in blocks of 3: two full blocks and a ragged last one
+    out, out_dist = _inputs()
+    assert torch.autograd.gradcheck(lambda a, b: LogSumExpMM.apply(a, b, 2.0, 3), (out, out_dist))
+
+
+def test_logsumexp_mm_matches_dense():
+    out, out_dist = _inputs()
+    ref_out = out.detach().clone().requires_grad_()
+    ref_out_dist = out_dist.detach().clone().requires_grad_()
+    grad = torch.randn(out.shape[0], dtype=torch.float64)
+
+    lse = LogSumExpMM.apply(out, out_dist, 2.0, 3)
+    ref = torch.logsumexp(ref_out @ ref_out_dist.t() * 2.0, dim=-1)
+    lse.backward(grad)
+    ref.backward(grad)
+
+    assert torch.allclose(lse, ref)
+    assert torch.allclose(out.grad, ref_out.grad)
+    assert torch.allclose(out_dist.grad, ref_out_dist.grad)
+
+
+def test_nt_xent_matches_baseline_formula():
+    temperature, eps = 0.5, 1e-6
+    generator = torch.Generator().manual_seed(0)
+    out = F.normalize(torch.randn(8, 16, generator=generator, dtype=torch.float64), dim=1)
+
+    # the original exp/sum formulation of the loss, non-distributed so out_dist is out
+    out_1, out_2 = out.chunk(2, dim=0)
+    neg = torch.exp(torch.mm(out, out.t()) / temperature).sum(dim=-1)
+    neg = torch.clamp(neg - math.e ** (1 / temperature), min=eps)
+    pos = torch.exp(torch.sum(out_1 * out_2, dim=-1) / temperature)
+    pos = torch.cat([pos, pos], dim=0)
+    ref = -torch.log(pos / (neg + eps)).mean()
+
+    # blocks of 3 over the 8 columns exercise the ragged multi-block path as well
+    assert torch.allclose(_nt_xent(out, out, temperature, eps, block_size=3), ref, atol=1e-6)
+    assert torch.allclose(_nt_xent(out, out, temperature, eps), ref, atol=1e-6)
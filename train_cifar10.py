@@ -30,6 +30,6 @@ checkpoint_callback = ModelCheckpoint(
 )
 
 simclr = SimCLR(arch='resnet18',mode='cifar10',gpus=1)
-trainer = pl.Trainer(callbacks=[checkpoint_callback],gpus=1)
+trainer = pl.Trainer(callbacks=[checkpoint_callback],gpus=1,precision='bf16')
 trainer.fit(simclr, train_loader)
 